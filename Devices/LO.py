@@ -39,6 +39,8 @@ class KuhnePLL():
         self.device.close()
         
     def connect(self):
+        # Digit groups last acknowledged by the device, see setHz()
+        self.lastGroups = {}
         try:
             self.device = serial.Serial(
                 port = self.port,
@@ -70,7 +72,7 @@ class KuhnePLL():
             self.logger.error(f"Sending command to oscillator failed with reason: {err}")
             return -1, err
 
-    def setHz(self, val, retries = 3):
+    def setHz(self, val, retries = 3, skipUnchanged = False):
         # TODO: Soft fail if device is None
         hz = str(round((np.floor(val) % 1000))).zfill(3)
         khz = str(round(np.floor(val*1e-3) % 1000)).zfill(3)
@@ -79,6 +81,11 @@ class KuhnePLL():
 
         
         for (freq, prefix) in zip([ghz, mhz, khz, hz], ["G", "M", "k", "H"]):
+            # Neighbouring points of a sweep share most digit groups, optionally only send the ones that changed.
+            # Opt-in, as changes from the front panel or another instance are not seen here.
+            if skipUnchanged and self.lastGroups.get(prefix) == freq:
+                continue
+            
             if self.legacy:
                 cmd = f"{freq}{prefix}F1"
             else:
@@ -98,7 +105,11 @@ class KuhnePLL():
             
             if not successful:
                 self.logger.error("Could not send command to device.")
+                # The state of the device is unknown, resend every group next time
+                self.lastGroups = {}
                 return False
+            
+            self.lastGroups[prefix] = freq
 
         return True
     
@@ -15,10 +15,13 @@ this program. If not, see https://www.gnu.org/licenses/.
 
 import pandas as pd
 import numpy as np
-import struct
 import time
 import logging
 
+def parseFloats(resp):
+    "Parse a comma separated list of floats, as sent by the lock-in, into a float64 array"
+    return np.fromstring(resp.strip().strip(','), sep = ',')
+
 class SR830M():
     def __init__(self, rm, address):
         # Set up logger
@@ -39,6 +42,8 @@ class SR830M():
             self.serial = False
 
         self.device.timeout = 100000
+        # Buffer transfers can be tens of kilobytes, read them in as few calls as possible
+        self.device.chunk_size = 1 << 20
 
         self.bufferSize = 16383
 
@@ -529,7 +534,24 @@ class SR830M():
         #TODO: implement
         return None
 
-    def snapshot(self, params):
+    def snapshot(self, params, asDict = False):
+        """
+        Read up to six values at the same instant with a single SNAP? query.
+
+        Parameters
+        ----------
+        params : str or list of str
+            Values to read, e.g. "X", "Y", "R", "THETA", "AUX1" or "REF".
+        asDict : Bool, optional
+            Return a dictionary keyed by the requested names instead of a list.
+            The default is False.
+
+        Returns
+        -------
+        list of floats or dict
+            The values in the order they were requested.
+
+        """
         if type(params) == str:
             params = [params]
             
@@ -555,15 +577,17 @@ class SR830M():
             joined = ",".join(indices)
             cmd = "SNAP? " + joined
             #self.logger.info(cmd)
-            resp = self.device.query(cmd)
-            return list(map(float, resp.split(',')))[0:1]
+            values = parseFloats(self.device.query(cmd))[0:1].tolist()
 
         else:
             joined = ",".join(indices)
             cmd = "SNAP? " + joined
             #self.logger.info(cmd)
-            resp = self.device.query(cmd)
-            return list(map(float, resp.split(',')))
+            values = parseFloats(self.device.query(cmd)).tolist()
+        
+        if asDict:
+            return dict(zip(params, values))
+        return values
     
     def readBinNum(self):
         res = self.device.query('SPTS?')
@@ -582,27 +606,79 @@ class SR830M():
     
         return response
     
-    def queryASCIIFloat(self, param):
+    def queryASCIIFloat(self, param, out = None):
         # Increse timeout, otherwise the transfer takes too long
         oldTimeout = self.device.timeout
         self.device.timeout = 60000 # 1 minute
     
         resp = self.device.query(param)
         
-        decoded = list(map(float, resp.strip(',').split(',')))
+        # Parse straight into a float array instead of a list of Python floats
+        decoded = parseFloats(resp)
     
         # Reset the timeout
         self.device.timeout = oldTimeout
+        
+        if out is not None and len(out) >= len(decoded):
+            out[:len(decoded)] = decoded
+            return out[:len(decoded)]
     
         return decoded
 
-    def queryBinaryFloat(self, param):
+    def queryBinaryFloat(self, param, out = None):
         response = self.queryBinary(param)
         entries = len(response) // 4
-        data = struct.unpack(f"{entries}f", response)
-        return list(data)
+        
+        # View the IEEE floats in place instead of unpacking them into Python objects
+        data = np.frombuffer(response, dtype = '<f4', count = entries)
+        
+        if out is not None and len(out) >= entries:
+            out[:entries] = data
+            return out[:entries]
+        
+        return data.astype(np.float64)
     
-    def readBuffer(self, buffer, firstPoint = 0, numPoints = 0):
+    def queryNonNormalizedFloat(self, param, entries, out = None):
+        """
+        Query buffer data in the non-normalized binary format (TRCL) and convert it to floats.
+        Every point is a 16 bit mantissa followed by a 16 bit exponent, both little-endian,
+        representing mantissa * 2^(exponent - 124). Since the number of bytes is known in
+        advance, this also works over serial, where termination characters may appear in the data.
+
+        Parameters
+        ----------
+        param : str
+            TRCL query to send.
+        entries : int
+            Number of points requested by the query.
+        out : numpy.ndarray, optional
+            Preallocated float array to decode into. The default is None.
+
+        Returns
+        -------
+        Numpy array of floats, a view into out if it was used.
+        """
+        # Increse timeout, otherwise the transfer takes too long
+        oldTimeout = self.device.timeout
+        self.device.timeout = 60000 # 1 minute
+        
+        self.device.write(param)
+        response = self.device.read_bytes(4*entries)
+        
+        # Reset the timeout
+        self.device.timeout = oldTimeout
+        
+        words = np.frombuffer(response, dtype = '<i2')
+        
+        if out is not None and len(out) >= entries:
+            data = out[:entries]
+        else:
+            data = np.empty(entries)
+            
+        np.ldexp(words[0::2], words[1::2] - 124, out = data)
+        return data
+    
+    def readBuffer(self, buffer, firstPoint = 0, numPoints = 0, out = None, binary = True):
         bufferSize = self.readBinNum()
 
         if bufferSize == 0:
@@ -620,12 +696,24 @@ class SR830M():
             self.logger.info("Requested too many points, clamping it.")
             numPoints = bufferSize - firstPoint
 
-        if self.serial:
+        if not binary:
             queryStr = f"TRCA ? {buffer}, {firstPoint}, {numPoints}"
-            return self.queryASCIIFloat(queryStr)
+            return self.queryASCIIFloat(queryStr, out = out)
+        elif self.serial:
+            # Binary transfer is about three times shorter than TRCA and needs no float parsing
+            queryStr = f"TRCL ? {buffer}, {firstPoint}, {numPoints}"
+            return self.queryNonNormalizedFloat(queryStr, numPoints, out = out)
         else:
             queryStr = f"TRCB ? {buffer}, {firstPoint}, {numPoints}"
-            return self.queryBinaryFloat(queryStr)
+            return self.queryBinaryFloat(queryStr, out = out)
+
+    def readBinaryBuffer(self, buffer, firstPoint = 0, numPoints = 0, out = None):
+        "Read points from a data buffer with a binary transfer, TRCL over serial and TRCB over GPIB"
+        return self.readBuffer(buffer, firstPoint, numPoints, out = out, binary = True)
+
+    def readASCIIBuffer(self, buffer, firstPoint = 0, numPoints = 0, out = None):
+        "Read points from a data buffer as ASCII with TRCA, mainly for checking the binary transfers"
+        return self.readBuffer(buffer, firstPoint, numPoints, out = out, binary = False)
    
     def resetBuffer(self):
         self.device.write("REST")
@@ -642,7 +730,36 @@ class SR830M():
         else:
             self.device.write("TSTR 0")
    
-    def multiRead(self, ch1 = None, ch2 = None, t = 1, srate = None, wait = False):
+    def _applySampleRate(self, srate):
+        "Set the sample rate the way multiRead() does and return it in Hz"
+        if srate is None:
+            return self.setSampleRate(None)
+        else:
+            return self.setSamplerateHz(srate)
+
+    def sampleCount(self, t = 1, srate = None):
+        """
+        Set the sample rate for an acquisition and return the number of samples multiRead() reads.
+        Used to size the result storage of a sweep once, instead of for the highest sample rate.
+
+        Parameters
+        ----------
+        t : float, optional
+            Acqusition time in seconds. The default is 1.
+        srate : float, optional
+            Sampling rate in Hz, see multiRead(). The default is None.
+
+        Returns
+        -------
+        int
+            Number of samples per channel, 0 if the sample rate could not be set.
+        """
+        srate = self._applySampleRate(srate)
+        if srate <= 0:
+            return 0
+        return int(np.floor(srate * t))
+
+    def multiRead(self, ch1 = None, ch2 = None, t = 1, srate = None, wait = False, out1 = None, out2 = None):
         """
         Capture the given data on each channel for an amount of time and return the results.
 
@@ -664,13 +781,21 @@ class SR830M():
             If True, it will extent the desired time if there are not enough points in the buffer.
             If False, will return all points gathered up until the desired timer is up.
             The default is False.
+        out1 : numpy.ndarray, optional
+            Preallocated float array to read channel 1 into. If it is too short,
+            a new container is allocated instead. The default is None.
+        out2 : numpy.ndarray, optional
+            Preallocated float array to read channel 2 into. If it is too short,
+            a new container is allocated instead. The default is None.
 
         Returns
         -------
         ch1
             Numpy array of floats containing the data from channel 1.
+            A view into out1 if it was used.
         ch2
             Numpy array of floats containing the data from channel 2.
+            A view into out2 if it was used.
 
         """
         readCh1 = False
@@ -685,11 +810,7 @@ class SR830M():
         if (not readCh1) and (not readCh2):
             return None, None
         
-        if srate is None:
-            srate = self.setSampleRate(None)
-        else:
-            srate = self.setSamplerateHz(srate)
-            
+        srate = self._applySampleRate(srate)
         self.logger.info(f"Sample rate is {srate}")
             
         if srate <= 0:
@@ -700,21 +821,26 @@ class SR830M():
             self.logger.error("Sampling is too slow for the selected time period.")
             return None, None
         
-        n = np.floor(srate * t)
+        n = int(np.floor(srate * t))
         
-        self.pauseBuffer()
-        self.resetBuffer()
-        self.enableTrigger()
-        self.triggerBuffer()
-        
-        time.sleep(t)
+        # Same as pauseBuffer, resetBuffer, enableTrigger and triggerBuffer, in a single write
+        self.device.write("PAUS;REST;TSTR 1;TRIG")
+        start = time.monotonic()
         
         if wait:
-            for i in range(100):
-                if self.readBinNum() >= n:
+            # Sleep only until the last requested point is due, then poll the
+            # buffer for it, giving up 10 s after the acquisition time is over.
+            # Each poll sleeps just as long as the missing points take to arrive,
+            # but never past the deadline.
+            time.sleep(n/srate)
+            deadline = start + t + 10
+            while time.monotonic() < deadline:
+                missing = n - self.readBinNum()
+                if missing <= 0:
                     break
-                else:
-                    time.sleep(0.1)
+                time.sleep(max(0, min(missing/srate, deadline - time.monotonic())))
+        else:
+            time.sleep(t)
             
         dataCh1 = None
         dataCh2 = None
@@ -722,10 +848,10 @@ class SR830M():
         self.pauseBuffer()
         
         if readCh1:
-            dataCh1 = self.readBuffer(1, 0, n)
+            dataCh1 = self.readBuffer(1, 0, n, out = out1)
         
         if readCh2:
-            dataCh2 = self.readBuffer(2, 0, n)
+            dataCh2 = self.readBuffer(2, 0, n, out = out2)
             
         return dataCh1, dataCh2
 
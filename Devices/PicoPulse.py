@@ -13,6 +13,8 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see https://www.gnu.org/licenses/.
 """
 
+import numpy as np
+
 """
 pico-pulse sequence synthesizer
 """
@@ -37,9 +39,38 @@ class PicoPulse():
 
         """
         self.device = rm.open_resource(addr)
+        self.device.chunk_size = 1 << 20
         self.assignments = assignments
 
-    def encodeSequence(self, seq, cycle = False, innerLoop = 0, outerLoop = None):
+        # Last command sent and its response, used to skip identical re-uploads
+        self.lastCommand = None
+        self.lastResponse = None
+
+    def encodeSequence(self, seq, cycle = False, innerLoop = 0, outerLoop = None, columns = None):
+        """
+        Encode a pulse sequence into a command string for the device.
+
+        Parameters
+        ----------
+        seq : pandas.DataFrame or numpy.ndarray
+            Pulse sequence, one step per row. Must contain a "time" column
+            (in nanoseconds) and one column per output channel.
+        cycle : Bool, optional
+            Whether to use cyclic mode. The default is False.
+        innerLoop : int, optional
+            Number of inner loops. The default is 0.
+        outerLoop : int, optional
+            Number of outer loops. If None, loop indefinitely. The default is None.
+        columns : sequence of str, optional
+            Column names of seq if it is a numpy array. Ignored for DataFrames.
+            The default is None.
+
+        Returns
+        -------
+        cmd : str
+            Encoded command.
+
+        """
         cmd = ""
         if cycle:
             cmd += "CPULSE"
@@ -61,34 +92,64 @@ class PicoPulse():
 
         cmd += f" {n} "
 
+        # Plain arrays skip the pandas overhead, their column names are passed separately
+        if isinstance(seq, np.ndarray):
+            cols = {name: seq[:, i] for (i, name) in enumerate(columns)}
+        else:
+            cols = {name: seq[name].to_numpy() for name in seq.columns}
+
         if self.assignments is not None:
-            seq.rename(
-                columns = self.assignments,
-                inplace = True
-            )
-
-        for i in range(len(seq)):
-            t = round(seq.time[i])
-            t = t if t > 0 else 0
-
-            out = 0
-            if "ch1" in seq and seq.ch1[i] > 0:
-                out += 1
-            if "ch2" in seq and seq.ch2[i] > 0:
-                out += 2
-            if "ch3" in seq and seq.ch3[i] > 0:
-                out += 4
-            if "ch4" in seq and seq.ch4[i] > 0:
-                out += 8
-            if "ch5" in seq and seq.ch5[i] > 0:
-                out += 16
-
-
-            cmd += f"{t},{out},"
+            cols = {self.assignments.get(name, name): col for (name, col) in cols.items()}
+
+        # Negative durations are clamped to zero
+        times = np.round(cols["time"]).astype(np.int64)
+        times[times < 0] = 0
+        steps = len(times)
+
+        # Each channel sets a single bit of the output state
+        outs = np.zeros(steps, dtype = np.int64)
+        for bit, ch in enumerate(["ch1", "ch2", "ch3", "ch4", "ch5"]):
+            if ch in cols:
+                outs += (cols[ch] > 0).astype(np.int64) << bit
+
+        # Format every "time,output," pair in a single call
+        interleaved = np.empty(2*steps, dtype = np.int64)
+        interleaved[0::2] = times
+        interleaved[1::2] = outs
+        cmd += ("%d,%d," * steps) % tuple(interleaved.tolist())
 
         return cmd
 
-    def sendSequence(self, seq, **kwargs):
+    def sendSequence(self, seq, skipIfSame = False, **kwargs):
         cmd = self.encodeSequence(seq, **kwargs)
+        return self.sendCommand(cmd, skipIfSame = skipIfSame)
+
+    def sendCommand(self, cmd, skipIfSame = False):
+        """
+        Send a command string, e.g. one returned by encodeSequence(), and return the response.
+
+        Parameters
+        ----------
+        cmd : str
+            Command to send.
+        skipIfSame : Bool, optional
+            Do not send the command if it matches the last one sent, and return the
+            previous response instead. Only use this for sequences that loop indefinitely
+            (outerLoop = None): a sequence with a finite number of loops stops after it
+            has run, and sending it again is how it is restarted. Only uploads made through
+            this object are tracked, so do not use it for commands that must reach the
+            device, e.g. turning the laser off. The default is False.
+
+        Returns
+        -------
+        res : str
+            Response of the device.
+
+        """
+        if skipIfSame and cmd == self.lastCommand:
+            return self.lastResponse
+
         res = self.device.query(cmd)
+        self.lastCommand = cmd
+        self.lastResponse = res
         return res
@@ -1,9 +1,11 @@
 class HP83752A():
     def __init__(self, rm, address):
         self.device = rm.open_resource(address)
+        self.device.chunk_size = 1 << 20
         self.freqRange = (0.01,20)
         self.powerRange = (-80,20)
         self.timeRange = (0,100)
+        self.listSize = 801
 
     def setupSweep(self, min, max, time):
         self.device.write("FREQ:MODE SWE")
@@ -20,6 +22,39 @@ class HP83752A():
     def readSweepTime(self):
         return float(self.device.query("SWE:TIME?"))
 
+    def setupListSweep(self, freqs, dwell = None, stepped = False):
+        """
+        Upload a list of frequencies in a single command and switch to list sweep mode,
+        so the sweeper steps through them on its own instead of one setCW call per point.
+
+        Parameters
+        ----------
+        freqs : array of floats
+            Frequencies in GHz, in the order they should be visited.
+            At most listSize (801) points fit in the list memory of the sweeper.
+        dwell : float, optional
+            Dwell time at each frequency in seconds. If None, keep the current setting.
+            The default is None.
+        stepped : bool, optional
+            If True, only advance to the next frequency on a bus trigger, see stepList().
+            Used to step through the list in sync with a measurement loop. The default is False.
+        """
+        if len(freqs) > self.listSize:
+            raise Exception(f'The sweeper list holds at most {self.listSize} points, got {len(freqs)}.')
+        points = ",".join(f"{f:.9f} GHZ" for f in freqs)
+        self.device.write(f"LIST:FREQ {points}")
+        if dwell is not None:
+            self.device.write(f"LIST:DWEL {dwell} s")
+        if stepped:
+            self.device.write("LIST:TRIG:SOUR BUS")
+        else:
+            self.device.write("LIST:TRIG:SOUR IMM")
+        self.device.write("FREQ:MODE LIST")
+
+    def stepList(self):
+        "Advance a stepped list sweep to the next frequency"
+        self.device.write("*TRG")
+
     def resetMarkers(self):
         self.device.write("MARK:AOFF")
     
@@ -13,17 +13,39 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see https://www.gnu.org/licenses/.
 """
 
-import pyvisa
 import pandas as pd
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.notebook import tqdm
 from Devices.LockIn import SR830M
 from Devices.LO import KuhnePLL
 from Devices.PicoPulse import PicoPulse
+from Utilities.Resources import getResourceManager
+from Utilities.DataSaving import ResultTable, saveDataFrame
+from Utilities.Statistics import meanStd
+
+# Column names of the sequence arrays sent to the pico-pulse
+_COLS = ("time", "lockin", "laser", "I", "Q")
+
+# Columns of the CW.iterateCW() result table. None marks columns holding
+# arbitrary Python objects, such as the raw sample arrays.
+_RESULT_DTYPES = {
+    "freq_GHz": np.float64,
+    "Rs_V": None,
+    "Rmean": np.float64,
+    "Rstd": np.float64,
+    "thetas_deg": None,
+    "settle_s": np.float64,
+    "measure_s": np.float64,
+    "timestamp": np.float64,
+    "lockin_freq_set_Hz": np.float64,
+    "lockin_freq_measured_Hz": np.float64,
+    "comment": None,
+}
 
 class CW():
-    def __init__(self, lo_addr, lock_addr, pico_addr, pico_pins):
+    def __init__(self, lo_addr, lock_addr, pico_addr, pico_pins, lo = None, lock = None, pico = None):
         """
         Initialize CW experiment.
 
@@ -38,6 +60,13 @@ class CW():
         pico_pins : dict
             Pin definitions for the pico-pulse device. Must map the keys
             'lockin', 'laser', 'I' and 'Q' to their respective channels.
+        lo : Devices.LO.KuhnePLL, optional
+            Already opened oscillator to use instead of opening lo_addr. The default is None.
+        lock : Devices.LockIn.SR830M, optional
+            Already opened lock-in amplifier to use instead of opening lock_addr. The default is None.
+        pico : Devices.PicoPulse.PicoPulse, optional
+            Already opened pico-pulse device to use instead of opening pico_addr.
+            Its pin assignments must match pico_pins. The default is None.
 
         Returns
         -------
@@ -48,6 +77,8 @@ class CW():
         self.lock_addr = lock_addr
         self.pico_addr = pico_addr
         self.pico_pins = pico_pins
+        # Devices opened by the caller, these are reused instead of opening new sessions
+        self.shared = {"lo": lo, "lock": lock, "pico": pico}
         self.setupDevices()
         self.idleSeq()
         
@@ -56,17 +87,17 @@ class CW():
         self.unloadDevices()
         
     def setupDevices(self):
-        self.rm = pyvisa.ResourceManager()
-        self.lo = KuhnePLL(self.lo_addr)
-        self.lock = SR830M(self.rm, self.lock_addr)
-        self.pico = PicoPulse(self.rm, self.pico_addr, self.pico_pins)
+        self.rm = getResourceManager()
+        self.lo = self.shared["lo"] if self.shared["lo"] is not None else KuhnePLL(self.lo_addr)
+        self.lock = self.shared["lock"] if self.shared["lock"] is not None else SR830M(self.rm, self.lock_addr)
+        self.pico = self.shared["pico"] if self.shared["pico"] is not None else PicoPulse(self.rm, self.pico_addr, self.pico_pins)
         
     def unloadDevices(self):
         self.idleSeq() # Turn off laser before unloading the device
         self.lo = None
         self.lock = None
         self.pico = None
-        self.rm.close()
+        # The resource manager is shared and stays open until exit
         self.rm = None
         
     def refreshDevices(self):
@@ -75,31 +106,26 @@ class CW():
         
     def idleSeq(self, freq = 500):
         halft = round(1e9/(freq*2))
-        seq = pd.DataFrame(
-            columns = ["time", "lockin", "laser", "I", "Q"],
-            data = [
-                [halft, 1, 0, 0, 0],
-                [halft, 0, 0, 0, 0]
-            ]
-        )
-        
-        self.pico.sendSequence(seq, cycle = False)
+        seq = np.array([
+            [halft, 1, 0, 0, 0],
+            [halft, 0, 0, 0, 0]
+        ], dtype = np.float64)
+        
+        self.pico.sendSequence(seq, columns = _COLS, cycle = False)
         self.idle = True
         
     def cwSeq(self, freq = 500):
         halft = round(1e9/(freq*2))
-        seq = pd.DataFrame(
-            columns = ["time", "lockin", "Q", "I", "laser"],
-            data = [
-                [halft, 1, 1, 1, 1],
-                [halft, 0, 0, 0, 1]
-            ]
-        )
-        
-        self.pico.sendSequence(seq, cycle = False)
+        seq = np.array([
+            [halft, 1, 1, 1, 1],
+            [halft, 0, 1, 0, 0]
+        ], dtype = np.float64)
+        
+        self.pico.sendSequence(seq, columns = _COLS, cycle = False, skipIfSame = True)
         self.idle = False
         
-    def measureCW(self, freq, settle = 1, integrate = 5, srate = None, lockin_freq = 500, comment = ""):
+    def measureCW(self, freq, settle = 1, integrate = 5, srate = None, lockin_freq = 500, comment = "",
+                  _skip_unchanged = False):
         """
         Measures CW ODMR signal at a given frequency.
 
@@ -117,6 +143,9 @@ class CW():
             Set lock-in reference frequency in Hz. The default is 500.
         comment : str, optional
             Attach a comment to the data point. The default is "".
+        _skip_unchanged : Bool, optional
+            Only send the digit groups of the frequency that changed since the last point.
+            Used by CW.iterateCW() after its first point. The default is False.
 
         Returns
         -------
@@ -124,13 +153,18 @@ class CW():
             Dictionary containing results and supplementary info.
 
         """
-        self.lo.setGHz(freq)
-        
         # If idle, start the CW sequence and mark that we wish to make it idle once we're done
-        returnToIdle = False
-        if self.idle:
-            self.cwSeq(lockin_freq)
-            returnToIdle = True
+        returnToIdle = self.idle
+        
+        if returnToIdle:
+            # The oscillator and the pico-pulse are on separate ports, configure them in parallel
+            with ThreadPoolExecutor(max_workers = 2) as pool:
+                tasks = [pool.submit(self.lo.setGHz, freq, skipUnchanged = _skip_unchanged),
+                         pool.submit(self.cwSeq, lockin_freq)]
+                for task in tasks:
+                    task.result()
+        else:
+            self.lo.setGHz(freq, skipUnchanged = _skip_unchanged)
         
         time.sleep(settle)
         Rs, thetas = self.lock.multiRead(ch1 = "R", ch2 = "THETA", t = integrate, srate = srate)
@@ -140,12 +174,15 @@ class CW():
         if returnToIdle:
             self.idleSeq(lockin_freq)
         
+        Rmean, Rstd = meanStd(Rs)
+        
+        # Single precision is plenty for the lock-in samples and halves the stored size
         return {
             "freq_GHz": freq,
-            "Rs_V": Rs,
-            "Rmean": np.mean(Rs),
-            "Rstd":  np.std(Rs),
-            "thetas_deg": thetas,
+            "Rs_V": np.asarray(Rs, dtype = np.float32),
+            "Rmean": Rmean,
+            "Rstd":  Rstd,
+            "thetas_deg": np.asarray(thetas, dtype = np.float32),
             "settle_s": settle,
             "measure_s": integrate,
             "timestamp": time.time(),
@@ -155,7 +192,7 @@ class CW():
         }
         
         
-    def iterateCW(self, fs, savedir = None, savename = "CW", lockin_freq = 500, shuffle = False, **kwargs):
+    def iterateCW(self, fs, savedir = None, savename = "CW", lockin_freq = 500, shuffle = False, blocks = None, seed = None, **kwargs):
         """
         Iterate over an array of frequencies and measure CW ODMR signal at them.
 
@@ -164,13 +201,20 @@ class CW():
         fs : array of floats
             Frequencies to iterate over.
         savedir : str, optional
-            Save directory. If not None, dump result into a JSON file at the given directory. The default is None.
+            Save directory. If not None, append each result as a line to a newline-delimited JSON file at the given directory
+            while measuring, and save the full result into a Parquet file (JSON if pyarrow is unavailable) at the end. The default is None.
         savename : str, optional
             String to append to saved filename. The default is "CW".
         lockin_freq : float, optional
             Set lock-in reference frequency in Hz. The default is 500.
         shuffle : Bool, optional
             Whether or not to shuffle the array beforehand. Useful for eliminating centrain measurement artifacts. The default is False.
+        blocks : int, optional
+            If set together with shuffle, split the array into this many consecutive blocks and only shuffle the order
+            of the blocks. Keeps the frequency steps within a block small, which reduces the settling time of the oscillator.
+            The default is None.
+        seed : int, optional
+            Seed for the shuffle, set it to reproduce the order of a previous run. The default is None.
         **kwargs : TYPE
             Pass arguments to CW.measureCW(). The valid arguments are "settle", "integrate", "srate" and "comment".
 
@@ -182,22 +226,39 @@ class CW():
         """
  
         self.cwSeq(lockin_freq)
-        tmp = []
         
         if shuffle:
-            np.random.shuffle(fs)
-            
+            rng = np.random.default_rng(seed)
+            if blocks is None:
+                rng.shuffle(fs)
+            else:
+                parts = np.array_split(fs, blocks)
+                fs = np.concatenate([parts[k] for k in rng.permutation(len(parts))])
+        
+        # Lock-in samples per point at the sample rate of the sweep
+        n = len(fs)
+        size = self.lock.sampleCount(kwargs.get("integrate", 5), kwargs.get("srate"))
+        
+        # Results go into preallocated columns and, if saving, a journal file written from a background thread
+        ts = round(time.time())
+        journal = None
+        if savedir is not None:
+            journal = f"{savedir}/{ts}_{savename}.ndjson"
+        table = ResultTable(_RESULT_DTYPES, n, size, journal = journal)
         
-        for f in tqdm(fs):
-            tmp.append(self.measureCW(f, **kwargs))
+        try:
+            for i, f in enumerate(tqdm(fs, mininterval = 1.0, smoothing = 0.1)):
+                # The first point sends the full frequency, in case the oscillator was changed elsewhere
+                row = self.measureCW(f, _skip_unchanged = i > 0, **kwargs)
+                table.add(i, row)
+        finally:
+            table.close()
         
-        df = pd.DataFrame.from_dict(tmp)
-        tmp = None
+        df = table.toDataFrame()
+        table = None
         
         if savedir is not None:
-            ts = round(time.time())
-            fname = f"{savedir}/{ts}_{savename}"
-            df.to_json(fname)
+            saveDataFrame(df, f"{savedir}/{ts}_{savename}", background = True)
         
         self.idleSeq(lockin_freq)
         return df
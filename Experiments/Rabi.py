@@ -13,17 +13,62 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see https://www.gnu.org/licenses/.
 """
 
-import pyvisa
 import pandas as pd
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.notebook import tqdm
 from Devices.LockIn import SR830M
 from Devices.LO import KuhnePLL
 from Devices.PicoPulse import PicoPulse
+from Utilities.Resources import getResourceManager
+from Utilities.DataSaving import ResultTable, saveDataFrame
+from Utilities.Statistics import meanStd
+
+# Column names of the sequence arrays sent to the pico-pulse
+_COLS = ("time", "lockin", "laser", "I", "Q")
+
+# Columns of the Rabi.iterateRabi() result table. None marks columns holding
+# arbitrary Python objects, such as the raw sample arrays.
+_RESULT_DTYPES = {
+    "tau_ns": np.float64,
+    "inner_halft_ns": np.float64,
+    "laser_duty_cycle": np.float64,
+    "loops": np.int64,
+    "Rs_V": None,
+    "Rmean": np.float64,
+    "Rstd": np.float64,
+    "thetas_deg": None,
+    "settle_s": np.float64,
+    "measure_s": np.float64,
+    "timestamp": np.float64,
+    "lockin_freq_measured_Hz": np.float64,
+    "comment": None,
+}
+
+# Number of encoded Rabi sequences kept by Rabi._rabiSeqFast()
+_COMMAND_CACHE_SIZE = 256
+
+def _rabiSequence(tau, tpad, laser_on, loops):
+    "Build the Rabi sequence array for the given timings (in nanoseconds)."
+    # Note: the sequence contains redundant pulses. This is to compensate any rounding errors.
+    mw = np.array([
+        [tpad,     1, 0, 0, 0],
+        [tau,      1, 0, 1, 1],
+        [laser_on, 1, 1, 0, 0]
+    ], dtype = np.float64)
+    
+    ref = np.array([
+        [tpad,     0, 0, 0, 0],
+        [tau,      0, 0, 0, 0],
+        [laser_on, 0, 1, 0, 0]
+    ], dtype = np.float64)
+    
+    # Microwave cycle followed by the reference cycle
+    return np.vstack((np.tile(mw, (loops, 1)), np.tile(ref, (loops, 1))))
 
 class Rabi():
-    def __init__(self, lo_addr, lock_addr, pico_addr, pico_pins):
+    def __init__(self, lo_addr, lock_addr, pico_addr, pico_pins, lo = None, lock = None, pico = None):
         """
         Initialize Rabi experiment.
     
@@ -38,6 +83,13 @@ class Rabi():
         pico_pins : dict
             Pin definitions for the pico-pulse device. Must map the keys
             'lockin', 'laser', 'I' and 'Q' to their respective channels.
+        lo : Devices.LO.KuhnePLL, optional
+            Already opened oscillator to use instead of opening lo_addr. The default is None.
+        lock : Devices.LockIn.SR830M, optional
+            Already opened lock-in amplifier to use instead of opening lock_addr. The default is None.
+        pico : Devices.PicoPulse.PicoPulse, optional
+            Already opened pico-pulse device to use instead of opening pico_addr.
+            Its pin assignments must match pico_pins. The default is None.
     
         Returns
         -------
@@ -48,6 +100,9 @@ class Rabi():
         self.lock_addr = lock_addr
         self.pico_addr = pico_addr
         self.pico_pins = pico_pins
+        # Devices opened by the caller, these are reused instead of opening new sessions
+        self.shared = {"lo": lo, "lock": lock, "pico": pico}
+        self._rabi_cmds = {}
         self.setupDevices()
         self.idleSeq()
         
@@ -56,17 +111,17 @@ class Rabi():
         self.unloadDevices()
         
     def setupDevices(self):
-        self.rm = pyvisa.ResourceManager()
-        self.lo = KuhnePLL(self.lo_addr)
-        self.lock = SR830M(self.rm, self.lock_addr)
-        self.pico = PicoPulse(self.rm, self.pico_addr, self.pico_pins)
+        self.rm = getResourceManager()
+        self.lo = self.shared["lo"] if self.shared["lo"] is not None else KuhnePLL(self.lo_addr)
+        self.lock = self.shared["lock"] if self.shared["lock"] is not None else SR830M(self.rm, self.lock_addr)
+        self.pico = self.shared["pico"] if self.shared["pico"] is not None else PicoPulse(self.rm, self.pico_addr, self.pico_pins)
         
     def unloadDevices(self):
         self.idleSeq() # Turn off laser before unloading the device
         self.lo = None
         self.lock = None
         self.pico = None
-        self.rm.close()
+        # The resource manager is shared and stays open until exit
         self.rm = None
         
     def refreshDevices(self):
@@ -75,15 +130,12 @@ class Rabi():
         
     def idleSeq(self, freq = 500):
         halft = round(1e9/(freq*2))
-        seq = pd.DataFrame(
-            columns = ["time", "lockin", "laser", "I", "Q"],
-            data = [
-                [halft, 1, 0, 0, 0],
-                [halft, 0, 0, 0, 0]
-            ]
-        )
-        
-        self.pico.sendSequence(seq, cycle = False)
+        seq = np.array([
+            [halft, 1, 0, 0, 0],
+            [halft, 0, 0, 0, 0]
+        ], dtype = np.float64)
+        
+        self.pico.sendSequence(seq, columns = _COLS, cycle = False)
         self.idle = True
              
     def rabiSeq(self, tau, inner_halft = 100e3, laser_duty_cycle = 0.9, loops = 100):
@@ -117,6 +169,20 @@ class Rabi():
 
         """
         
+        laser_on, laser_off = self._rabiTiming(inner_halft, laser_duty_cycle, loops)
+        tpad = laser_off - tau
+        if tpad < 20:
+            raise Exception('Cannot generate Rabi sequence, padding is too short. Consider increasing the inner period time or reducing the laser duty cycle.')
+        
+        self._rabiSeqFast(tau, tpad, laser_on, loops)
+        
+    def _rabiTiming(self, inner_halft, laser_duty_cycle, loops):
+        """
+        Validate the parameters shared by every point of a Rabi sweep and
+        return the laser on and off times in nanoseconds.
+        See Rabi.rabiSeq() for the parameters.
+        """
+        
         if laser_duty_cycle <= 0 or laser_duty_cycle >= 1:
             raise Exception('Laser duty cycle must be between 0 and 1 (exclusive).')
         
@@ -127,35 +193,31 @@ class Rabi():
 
         laser_on = round(inner_halft*laser_duty_cycle)
         laser_off = round(inner_halft - laser_on)
-        tpad = laser_off - tau
-        if tpad < 20:
-            raise Exception('Cannot generate Rabi sequence, padding is too short. Consider increasing the inner period time or reducing the laser duty cycle.')
+        return laser_on, laser_off
+        
+    def _rabiSeqFast(self, tau, tpad, laser_on, loops):
+        """
+        Send Rabi sequence with precomputed timings.
+        No validation is done, see Rabi.rabiSeq() for the parameters.
+        """
         
-        # Note: the sequence contains redundant pulses. This is to compensate any rounding errors.
-        temp = []
-        
-        # Microwave cycle
-        for i in range(loops):
-            temp.append([tpad,     1, 0, 0, 0])
-            temp.append([tau,      1, 0, 1, 1])
-            temp.append([laser_on, 1, 1, 0, 0])
-            
-        # Reference cycle
-        for i in range(loops):
-            temp.append([tpad,     0, 0, 0, 0])
-            temp.append([tau,      0, 0, 0, 0])
-            temp.append([laser_on, 0, 1, 0, 0])
-        
-        seq = pd.DataFrame(
-            columns = ["time", "lockin", "laser", "I", "Q"],
-            data = temp
-        )
+        # Sweeps revisit the same timings, so the encoded commands are cached
+        key = (tau, tpad, laser_on, loops)
+        cmd = self._rabi_cmds.get(key)
+        if cmd is None:
+            seq = _rabiSequence(tau, tpad, laser_on, loops)
+            cmd = self.pico.encodeSequence(seq, columns = _COLS, cycle = False)
+            if len(self._rabi_cmds) >= _COMMAND_CACHE_SIZE:
+                # Dictionaries keep insertion order, drop the oldest entry
+                del self._rabi_cmds[next(iter(self._rabi_cmds))]
+            self._rabi_cmds[key] = cmd
          
-        self.pico.sendSequence(seq, cycle = False)
+        self.pico.sendCommand(cmd, skipIfSame = True)
         self.idle = False
         
     def measureRabi(self, tau, inner_halft = 100e3, laser_duty_cycle = 0.9, loops = 100,
-                    mw_freq = None, settle = 1, integrate = 5, srate = None, comment = ""):
+                    mw_freq = None, settle = 1, integrate = 5, srate = None, comment = "", _tpad = None, _laser_on = None,
+                    _skip_idle = False):
         """
         Measure a single Rabi sequence.
 
@@ -182,6 +244,15 @@ class Rabi():
             Sampling rate of the lock-in amplifier. Set to None for automatic. The default is None.
         comment : str, optional
             Attach a comment to the data point. The default is "".
+        _tpad : int, optional
+            Precomputed padding length in nanoseconds, used by Rabi.iterateRabi().
+            If given together with _laser_on, the sequence is not validated again. The default is None.
+        _laser_on : int, optional
+            Precomputed laser on time in nanoseconds, used by Rabi.iterateRabi(). The default is None.
+        _skip_idle : Bool, optional
+            Do not return to the idle sequence afterwards, even if the device was idle.
+            Used by Rabi.iterateRabi(), where the next point replaces the sequence anyway.
+            The default is False.
 
         Returns
         -------
@@ -191,12 +262,22 @@ class Rabi():
         """
         
         
-        returnToIdle = self.idle
+        returnToIdle = self.idle and not _skip_idle
+        
+        if _tpad is None or _laser_on is None:
+            setSeq = lambda: self.rabiSeq(tau, inner_halft = inner_halft,
+                                          laser_duty_cycle = laser_duty_cycle, loops = loops)
+        else:
+            setSeq = lambda: self._rabiSeqFast(tau, _tpad, _laser_on, loops)
         
         if mw_freq is not None:
-            self.lo.setGHz(mw_freq)
-            
-        self.RabiSeq(tau, inner_halft = inner_halft, laser_duty_cycle = laser_duty_cycle, loops = loops)
+            # The oscillator and the pico-pulse are on separate ports, configure them in parallel
+            with ThreadPoolExecutor(max_workers = 2) as pool:
+                tasks = [pool.submit(setSeq), pool.submit(self.lo.setGHz, mw_freq)]
+                for task in tasks:
+                    task.result()
+        else:
+            setSeq()
         
         time.sleep(settle)
         Rs, thetas = self.lock.multiRead(ch1 = "R", ch2 = "THETA", t = integrate, srate = srate)
@@ -206,14 +287,16 @@ class Rabi():
         if returnToIdle:
             self.idleSeq(lockin_freq_measured)
         
+        Rmean, Rstd = meanStd(Rs)
+        
         return {
             "tau_ns": tau,
             "inner_halft_ns": inner_halft,
             "laser_duty_cycle": laser_duty_cycle,
             "loops": loops,
             "Rs_V": Rs,
-            "Rmean": np.mean(Rs),
-            "Rstd":  np.std(Rs),
+            "Rmean": Rmean,
+            "Rstd":  Rstd,
             "thetas_deg": thetas,
             "settle_s": settle,
             "measure_s": integrate,
@@ -223,7 +306,7 @@ class Rabi():
         }
 
     def iterateRabi(self, taus, inner_halft = 100e3, laser_duty_cycle = 0.9, loops = 100,
-                    mw_freq = None, savedir = None, savename = "T1", shuffle = False, **kwargs):
+                    mw_freq = None, savedir = None, savename = "T1", shuffle = False, seed = None, **kwargs):
         """
         Iterate over an array of taus and measure Rabi signal at them.
 
@@ -243,13 +326,16 @@ class Rabi():
         mw_freq: float, optinal
             Set microwave frequence in GHz. If None, do not set it. The default is None.
         savedir : str, optional
-            Save directory. If not None, dump result into a JSON file at the given directory. The default is None.
+            Save directory. If not None, append each result as a line to a newline-delimited JSON file at the given directory
+            while measuring, and save the full result into a Parquet file (JSON if pyarrow is unavailable) at the end. The default is None.
         savename : str, optional
             String to append to saved filename. The default is "T1".
         lockin_freq : float, optional
             Set lock-in reference frequency in Hz. The default is 64.
         shuffle : Bool, optional
             Whether or not to shuffle the array beforehand. Useful for eliminating centrain measurement artifacts. The default is False.
+        seed : int, optional
+            Seed for the shuffle, set it to reproduce the order of a previous run. The default is None.
         **kwargs : TYPE
             Pass arguments to T1.measureT1(). The valid arguments are "settle", "integrate", "srate" and "comment".
 
@@ -260,28 +346,43 @@ class Rabi():
 
         """
         
-        if round((1-laser_duty_cycle)*inner_halft) - np.max(taus) < 20:
-            raise Exception('At least one value of tau is too large for the given parameters.')
-            
         if mw_freq is not None:
             self.lo.setGHz(mw_freq)
  
-        tmp = []
-        
         if shuffle:
-            np.random.shuffle(taus)
-            
+            np.random.default_rng(seed).shuffle(taus)
+        
+        # The timings only depend on tau through the padding, compute them once for the whole sweep
+        laser_on, laser_off = self._rabiTiming(inner_halft, laser_duty_cycle, loops)
+        tpads = laser_off - np.asarray(taus)
+        if np.min(tpads) < 20:
+            raise Exception('At least one value of tau is too large for the given parameters.')
+        
+        # Lock-in samples per point at the sample rate of the sweep
+        n = len(tpads)
+        size = self.lock.sampleCount(kwargs.get("integrate", 5), kwargs.get("srate"))
+        
+        # Results go into preallocated columns and, if saving, a journal file written from a background thread
+        ts = round(time.time())
+        journal = None
+        if savedir is not None:
+            journal = f"{savedir}/{ts}_{savename}.ndjson"
+        table = ResultTable(_RESULT_DTYPES, n, size, journal = journal)
         
-        for tau in tqdm(taus):
-            tmp.append(self.measureRabi(tau, inner_halft = 100e3, laser_duty_cycle = 0.9, loops = 100, mw_freq = None, **kwargs))
+        try:
+            for i, (tau, tpad) in enumerate(tqdm(zip(taus, tpads), total = n, mininterval = 1.0, smoothing = 0.1)):
+                row = self.measureRabi(tau, inner_halft = inner_halft, laser_duty_cycle = laser_duty_cycle, loops = loops,
+                                       mw_freq = None, _tpad = tpad, _laser_on = laser_on,
+                                       _skip_idle = True, **kwargs)
+                table.add(i, row)
+        finally:
+            table.close()
         
-        df = pd.DataFrame.from_dict(tmp)
-        tmp = None
+        df = table.toDataFrame()
+        table = None
         
         if savedir is not None:
-            ts = round(time.time())
-            fname = f"{savedir}/{ts}_{savename}"
-            df.to_json(fname)
+            saveDataFrame(df, f"{savedir}/{ts}_{savename}", background = True)
         
         self.idleSeq(1e9/(inner_halft*loops*2))
         return df
\ No newline at end of file
@@ -13,16 +13,39 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see https://www.gnu.org/licenses/.
 """
 
-import pyvisa
 import pandas as pd
 import numpy as np
 import time
 from tqdm.notebook import tqdm
 from Devices.LockIn import SR830M
 from Devices.PicoPulse import PicoPulse
+from Utilities.Resources import getResourceManager
+from Utilities.DataSaving import ResultTable, saveDataFrame
+from Utilities.Statistics import meanStd
+
+# Column names of the sequence arrays sent to the pico-pulse
+_COLS = ("time", "lockin", "laser")
+
+# Columns of the T1.iterateT1() result table. None marks columns holding
+# arbitrary Python objects, such as the raw sample arrays.
+_RESULT_DTYPES = {
+    "tau_ns": np.float64,
+    "init_ns": np.float64,
+    "readout_ns": np.float64,
+    "Rs_V": None,
+    "Rmean": np.float64,
+    "Rstd": np.float64,
+    "thetas_deg": None,
+    "settle_s": np.float64,
+    "measure_s": np.float64,
+    "timestamp": np.float64,
+    "lockin_freq_set_Hz": np.float64,
+    "lockin_freq_measured_Hz": np.float64,
+    "comment": None,
+}
 
 class T1():
-    def __init__(self, lock_addr, pico_addr, pico_pins):
+    def __init__(self, lock_addr, pico_addr, pico_pins, lock = None, pico = None):
         """
         Initialize T1 experiment.
 
@@ -35,6 +58,11 @@ class T1():
         pico_pins : dict
             Pin definitions for the pico-pulse device. Must map the keys
             'lockin' and 'laser' to their respective channels.
+        lock : Devices.LockIn.SR830M, optional
+            Already opened lock-in amplifier to use instead of opening lock_addr. The default is None.
+        pico : Devices.PicoPulse.PicoPulse, optional
+            Already opened pico-pulse device to use instead of opening pico_addr.
+            Its pin assignments must match pico_pins. The default is None.
 
         Returns
         -------
@@ -44,6 +72,10 @@ class T1():
         self.lock_addr = lock_addr
         self.pico_addr = pico_addr
         self.pico_pins = pico_pins
+        # Devices opened by the caller, these are reused instead of opening new sessions
+        self.shared = {"lock": lock, "pico": pico}
+        self._t1_key = None
+        self._t1_template = None
         self.setupDevices()
         self.idleSeq()
         
@@ -51,15 +83,15 @@ class T1():
         self.unloadDevices()
         
     def setupDevices(self):
-        self.rm = pyvisa.ResourceManager()
-        self.lock = SR830M(self.rm, self.lock_addr)
-        self.pico = PicoPulse(self.rm, self.pico_addr, self.pico_pins)
+        self.rm = getResourceManager()
+        self.lock = self.shared["lock"] if self.shared["lock"] is not None else SR830M(self.rm, self.lock_addr)
+        self.pico = self.shared["pico"] if self.shared["pico"] is not None else PicoPulse(self.rm, self.pico_addr, self.pico_pins)
         
     def unloadDevices(self):
         self.idleSeq() # Turn off laser before unloading the device
         self.lock = None
         self.pico = None
-        self.rm.close()
+        # The resource manager is shared and stays open until exit
         self.rm = None
         
     def refreshDevices(self):
@@ -68,15 +100,12 @@ class T1():
          
     def idleSeq(self, freq = 500):
          halft = round(1e9/(freq*2))
-         seq = pd.DataFrame(
-             columns = ["time", "lockin", "laser"],
-             data = [
-                 [halft, 1, 0],
-                 [halft, 0, 0]
-             ]
-         )
+         seq = np.array([
+             [halft, 1, 0],
+             [halft, 0, 0]
+         ], dtype = np.float64)
          
-         self.pico.sendSequence(seq, cycle = False)
+         self.pico.sendSequence(seq, columns = _COLS, cycle = False)
          self.idle = True
          
     def T1seq(self, tau, init = 50e3, readout = 10e3, freq = 64):
@@ -110,28 +139,43 @@ class T1():
         tpad = halft - init - readout - tau
         if tpad < 20:
             raise Exception('Cannot generate T1 sequence, padding is too short. Consider decreasing the lock-in frequency.')
-             
-        # Note: the sequence contains redundant pulses. This is to compensate any rounding errors,
-        # i.e. tau + readout may not be exactly as long as tau and readout separately.
-        seq = pd.DataFrame(
-             columns = ["time", "lockin", "laser"],
-             data = [
-                 [init,    1, 1],
-                 [tau,     1, 0],
-                 [readout, 1, 1],
-                 [tpad,    1, 0],
-                 [init,    0, 1],
-                 [tau,     0, 0],
-                 [readout, 0, 0],
-                 [tpad,    0, 0]
-             ]
-         )
-         
-        self.pico.sendSequence(seq, cycle = False)
+        
+        self._T1seqFast(tau, tpad, init = init, readout = readout, freq = freq)
+        
+    def _T1seqFast(self, tau, tpad, init = 50e3, readout = 10e3, freq = 64):
+        """
+        Send T1 sequence with a precomputed padding length.
+        No validation is done, see T1.T1seq() for the parameters.
+        """
+        
+        # Only the tau and padding rows depend on tau, so the template is
+        # rebuilt only when the remaining parameters change.
+        key = (init, readout, freq)
+        if self._t1_key != key:
+            # Note: the sequence contains redundant pulses. This is to compensate any rounding errors,
+            # i.e. tau + readout may not be exactly as long as tau and readout separately.
+            self._t1_template = np.array([
+                [init,    1, 1],
+                [tau,     1, 0],
+                [readout, 1, 1],
+                [tpad,    1, 0],
+                [init,    0, 1],
+                [tau,     0, 0],
+                [readout, 0, 0],
+                [tpad,    0, 0]
+            ], dtype = np.float64)
+            self._t1_key = key
+        
+        self._t1_template[[1, 5], 0] = tau
+        self._t1_template[[3, 7], 0] = tpad
+        
+        # The pico-pulse skips the upload if it is already running this exact sequence
+        self.pico.sendSequence(self._t1_template, columns = _COLS, cycle = False, skipIfSame = True)
         self.idle = False
         
     def measureT1(self, tau, init = 50e3, readout = 10e3, settle = 1,
-                  integrate = 5, srate = None, lockin_freq = 64, comment = ""):
+                  integrate = 5, srate = None, lockin_freq = 64, comment = "", _tpad = None, _buffers = None,
+                  _skip_idle = False):
         """
         Measure a single T1 sequence.
 
@@ -153,6 +197,16 @@ class T1():
             Set lock-in reference frequency in Hz. The default is 64.
         comment : str, optional
             Attach a comment to the data point. The default is "".
+        _tpad : int, optional
+            Precomputed padding length in nanoseconds, used by T1.iterateT1().
+            If given, the sequence is not validated again. The default is None.
+        _buffers : tuple of numpy.ndarray, optional
+            Preallocated (R, theta) buffers for the lock-in readout, used by T1.iterateT1().
+            The returned samples are views into these buffers. The default is None.
+        _skip_idle : Bool, optional
+            Do not return to the idle sequence afterwards, even if the device was idle.
+            Used by T1.iterateT1(), where the next point replaces the sequence anyway.
+            The default is False.
 
         Returns
         -------
@@ -161,25 +215,34 @@ class T1():
 
         """
         
-        returnToIdle = self.idle
+        returnToIdle = self.idle and not _skip_idle
             
-        self.T1seq(tau, init = init, readout = readout, freq = lockin_freq)
+        if _tpad is None:
+            self.T1seq(tau, init = init, readout = readout, freq = lockin_freq)
+        else:
+            self._T1seqFast(tau, _tpad, init = init, readout = readout, freq = lockin_freq)
         
         time.sleep(settle)
-        Rs, thetas = self.lock.multiRead(ch1 = "R", ch2 = "THETA", t = integrate, srate = srate)
+        if _buffers is None:
+            Rs, thetas = self.lock.multiRead(ch1 = "R", ch2 = "THETA", t = integrate, srate = srate)
+        else:
+            Rs, thetas = self.lock.multiRead(ch1 = "R", ch2 = "THETA", t = integrate, srate = srate,
+                                             out1 = _buffers[0], out2 = _buffers[1])
         
         lockin_freq_measured = self.lock.getFreq()
         
         if returnToIdle:
             self.idleSeq(lockin_freq)
         
+        Rmean, Rstd = meanStd(Rs)
+        
         return {
             "tau_ns": tau,
             "init_ns": init,
             "readout_ns": readout,
             "Rs_V": Rs,
-            "Rmean": np.mean(Rs),
-            "Rstd":  np.std(Rs),
+            "Rmean": Rmean,
+            "Rstd":  Rstd,
             "thetas_deg": thetas,
             "settle_s": settle,
             "measure_s": integrate,
@@ -189,7 +252,7 @@ class T1():
             "comment": comment
         }
 
-    def iterateT1(self, taus, init = 50e3, readout = 10e3, savedir = None, savename = "T1", lockin_freq = 64, shuffle = False, **kwargs):
+    def iterateT1(self, taus, init = 50e3, readout = 10e3, savedir = None, savename = "T1", lockin_freq = 64, shuffle = False, seed = None, **kwargs):
         """
         Iterate over an array of taus and measure T1 signal at them.
 
@@ -202,13 +265,16 @@ class T1():
         readout : int, optional
             Readout pulse length in nanoseconds. The default is 10e3 (10 us).
         savedir : str, optional
-            Save directory. If not None, dump result into a JSON file at the given directory. The default is None.
+            Save directory. If not None, append each result as a line to a newline-delimited JSON file at the given directory
+            while measuring, and save the full result into a Parquet file (JSON if pyarrow is unavailable) at the end. The default is None.
         savename : str, optional
             String to append to saved filename. The default is "T1".
         lockin_freq : float, optional
             Set lock-in reference frequency in Hz. The default is 64.
         shuffle : Bool, optional
             Whether or not to shuffle the array beforehand. Useful for eliminating centrain measurement artifacts. The default is False.
+        seed : int, optional
+            Seed for the shuffle, set it to reproduce the order of a previous run. The default is None.
         **kwargs : TYPE
             Pass arguments to T1.measureT1(). The valid arguments are "settle", "integrate", "srate" and "comment".
 
@@ -219,25 +285,40 @@ class T1():
 
         """
         
-        if round(1e9/(lockin_freq*2)) - init - readout - np.max(taus) < 20:
+        if shuffle:
+            np.random.default_rng(seed).shuffle(taus)
+        
+        # Compute every padding length up front instead of once per tau
+        halft = round(1e9/(lockin_freq*2))
+        tpads = halft - init - readout - np.asarray(taus)
+        if np.min(tpads) < 20:
             raise Exception('At least one value of tau is too large for the given lockin frequency.')
  
-        tmp = []
+        # Lock-in readout buffers shared by all points, sized for the sample rate of the sweep
+        n = len(tpads)
+        size = self.lock.sampleCount(kwargs.get("integrate", 5), kwargs.get("srate"))
+        buffers = (np.empty(size), np.empty(size))
         
-        if shuffle:
-            np.random.shuffle(taus)
-            
+        # Results go into preallocated columns and, if saving, a journal file written from a background thread
+        ts = round(time.time())
+        journal = None
+        if savedir is not None:
+            journal = f"{savedir}/{ts}_{savename}.ndjson"
+        table = ResultTable(_RESULT_DTYPES, n, size, journal = journal)
         
-        for tau in tqdm(taus):
-            tmp.append(self.measureT1(tau, init = init, readout = readout, lockin_freq = lockin_freq, **kwargs))
+        try:
+            for i, (tau, tpad) in enumerate(tqdm(zip(taus, tpads), total = n, mininterval = 1.0, smoothing = 0.1)):
+                row = self.measureT1(tau, init = init, readout = readout, lockin_freq = lockin_freq,
+                                     _tpad = tpad, _buffers = buffers, _skip_idle = True, **kwargs)
+                table.add(i, row)
+        finally:
+            table.close()
         
-        df = pd.DataFrame.from_dict(tmp)
-        tmp = None
+        df = table.toDataFrame()
+        table = None
         
         if savedir is not None:
-            ts = round(time.time())
-            fname = f"{savedir}/{ts}_{savename}"
-            df.to_json(fname)
+            saveDataFrame(df, f"{savedir}/{ts}_{savename}", background = True)
         
         self.idleSeq(lockin_freq)
         return df
\ No newline at end of file
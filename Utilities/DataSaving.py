@@ -0,0 +1,244 @@
+"""
+Copyright (C) 2026 Bence Göblyös
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see https://www.gnu.org/licenses/.
+"""
+
+import json
+import logging
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+# pyarrow is listed in requirements.txt, without it results are saved as JSON
+try:
+    import pyarrow
+    _PARQUET = True
+except ImportError:
+    _PARQUET = False
+
+logger = logging.getLogger('TR-ODMR.DataSaving')
+
+# Saves running in the background, see waitForSaves()
+_pendingSaves = []
+
+def jsonDefault(obj):
+    "Convert numpy arrays and scalars into types the json module can serialize"
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def toJSONLine(row):
+    """
+    Serialize a single measurement into one line of newline-delimited JSON.
+
+    Parameters
+    ----------
+    row : dict
+        Dictionary returned by one of the measure* methods.
+
+    Returns
+    -------
+    str
+        JSON encoded row terminated by a newline.
+    """
+    return json.dumps(row, default = jsonDefault) + "\n"
+
+class JournalWriter():
+    def __init__(self, fname, maxsize = 64):
+        """
+        Append measurements to a newline-delimited JSON file from a background thread,
+        so serializing and writing a row overlaps with the next measurement.
+
+        Parameters
+        ----------
+        fname : str
+            Path of the journal file. Rows are appended if it already exists.
+        maxsize : int, optional
+            Number of rows that may wait for the writer before write() blocks.
+            The default is 64.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.fname = fname
+        self.error = None
+        self.queue = queue.Queue(maxsize = maxsize)
+        self.stream = open(fname, "a")
+        self.thread = threading.Thread(target = self._run)
+        self.thread.start()
+
+    def write(self, row):
+        "Queue a row returned by one of the measure* methods for writing"
+        self.queue.put(row)
+
+    def close(self):
+        "Write the queued rows, close the file and reraise the first write error, if any"
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            row = self.queue.get()
+            if row is None:
+                break
+            # Keep draining the queue after a failure, so write() never blocks forever
+            if self.error is None:
+                try:
+                    self.stream.write(toJSONLine(row))
+                    self.stream.flush()
+                except Exception as e:
+                    self.error = e
+        self.stream.close()
+
+class ResultTable():
+    def __init__(self, dtypes, points, samples, sampleColumns = ("Rs_V", "thetas_deg"), journal = None):
+        """
+        Preallocated storage for the results of a sweep. Rows returned by the
+        measure* methods are written into typed columns by index, instead of
+        collecting one dictionary per point and converting them at the end.
+
+        Parameters
+        ----------
+        dtypes : dict
+            Maps every column name to its numpy dtype. None marks columns holding
+            arbitrary Python objects, such as comments.
+        points : int
+            Number of points in the sweep.
+        samples : int
+            Number of samples a single point returns, see SR830M.sampleCount().
+            Longer sample arrays are truncated with a warning.
+        sampleColumns : tuple of str, optional
+            Columns holding sample arrays. These are copied into contiguous
+            (points, samples) float32 tables, padded with NaN. The default is ("Rs_V", "thetas_deg").
+        journal : str, optional
+            If not None, every row is also appended to this newline-delimited JSON file
+            from a background thread, see JournalWriter. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.columns = {
+            key: [None]*points if dtype is None else np.empty(points, dtype = dtype)
+            for (key, dtype) in dtypes.items()
+        }
+        self.samples = {
+            key: np.full((points, samples), np.nan, dtype = np.float32)
+            for key in sampleColumns
+        }
+        self.journal = None
+        if journal is not None:
+            self.journal = JournalWriter(journal)
+
+    def add(self, i, row):
+        """
+        Store a row returned by one of the measure* methods as the i-th point.
+        The sample arrays of the row are replaced by views into the sample tables.
+        """
+        for (key, table) in self.samples.items():
+            data = row[key]
+            k = min(len(data), table.shape[1])
+            if k < len(data):
+                logger.warning(f"Point {i} returned {len(data)} samples in {key}, only {k} are kept.")
+            table[i, :k] = data[:k]
+            row[key] = table[i, :k]
+
+        for (key, column) in self.columns.items():
+            column[i] = row[key]
+
+        if self.journal is not None:
+            self.journal.write(row)
+
+    def close(self):
+        "Finish writing the journal, if any"
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def toDataFrame(self):
+        "Collect the stored columns into a DataFrame"
+        return pd.DataFrame(self.columns)
+
+def saveDataFrame(df, fname, background = False):
+    """
+    Save a DataFrame in a binary columnar format.
+    Parquet is used if pyarrow is available, otherwise it falls back to JSON.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame to save.
+    fname : str
+        Path of the file without extension. The extension is added based on
+        the format used.
+    background : Bool, optional
+        Write the file from a background thread and return immediately.
+        Use waitForSaves() to make sure it has been written. The default is False.
+
+    Returns
+    -------
+    str
+        Path of the written file.
+    """
+    fname += ".parquet" if _PARQUET else ".json"
+
+    if background:
+        # Shallow copy, so columns added to the returned DataFrame do not race with the writer
+        thread = threading.Thread(target = _writeDataFrame, args = (df.copy(deep = False), fname))
+        thread.start()
+        _pendingSaves.append(thread)
+    else:
+        _writeDataFrame(df, fname)
+
+    return fname
+
+def loadDataFrame(fname):
+    """
+    Load results saved by saveDataFrame() or a journal written by JournalWriter.
+    The format is picked based on the extension.
+
+    Parameters
+    ----------
+    fname : str
+        Path of a .parquet, .json or .ndjson file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        DataFrame with each row representing a measurement.
+    """
+    if fname.endswith(".parquet"):
+        return pd.read_parquet(fname)
+    elif fname.endswith(".ndjson"):
+        return pd.read_json(fname, lines = True)
+    else:
+        return pd.read_json(fname)
+
+def waitForSaves():
+    "Block until every background save started by saveDataFrame() has finished"
+    while _pendingSaves:
+        _pendingSaves.pop().join()
+
+def _writeDataFrame(df, fname):
+    if _PARQUET:
+        df.to_parquet(fname, compression = "zstd")
+    else:
+        df.to_json(fname)
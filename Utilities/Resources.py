@@ -0,0 +1,53 @@
+"""
+Copyright (C) 2026 Bence Göblyös
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see https://www.gnu.org/licenses/.
+"""
+
+import atexit
+import pyvisa
+
+# Resource manager shared by every device and experiment, see getResourceManager()
+_rm = None
+
+def isOpen(rm):
+    "Check whether a resource manager has not been closed yet"
+    try:
+        rm.session
+        return True
+    except pyvisa.errors.InvalidSession:
+        return False
+
+def getResourceManager():
+    """
+    Return the VISA resource manager shared by every device and experiment.
+    It is opened on first use and closed when the interpreter exits.
+    pyvisa keeps a single resource manager per VISA library, so closing it
+    (including through pyvisa.ResourceManager().close()) closes the sessions
+    of every other user as well. If that happens, a new one is opened here
+    and devices opened on the old one have to be opened again.
+
+    Returns
+    -------
+    pyvisa.ResourceManager
+        Shared resource manager.
+    """
+    global _rm
+    if _rm is None or not isOpen(_rm):
+        _rm = pyvisa.ResourceManager()
+    return _rm
+
+def _closeResourceManager():
+    if _rm is not None and isOpen(_rm):
+        _rm.close()
+
+atexit.register(_closeResourceManager)
@@ -65,41 +65,43 @@ def visSeqEquidistant(seq):
     plt.ylim(centers[0]-0.7, centers[-1]+0.7)
     
     
+    # Format the step durations up front from the raw time column
+    timeLabels = [formatPrefix(t, "s") for t in seq["time"].to_numpy()*1e-9]
+    
     if n < 8:
-        for (i, row) in enumerate(seq.iterrows()):
-            t = row[1]["time"]*1e-9
-            plt.text(i + 0.5, -0.2, formatPrefix(t, "s"), ha = 'center')
+        for (i, label) in enumerate(timeLabels):
+            plt.text(i + 0.5, -0.2, label, ha = 'center')
     else:
-        for (i, row) in enumerate(seq.iterrows()):
-            t = row[1]["time"]*1e-9
-            plt.text(i + 0.5, -0.05, formatPrefix(t, "s"), ha = 'center',
+        for (i, label) in enumerate(timeLabels):
+            plt.text(i + 0.5, -0.05, label, ha = 'center',
                      rotation = 'vertical', va = 'top')
             
         
     return plt.show()
 
 def visSeqProportional(seq):
-    expand = 1e-3
+    t = np.sum(seq.time)
+    factor, prefix = getPrefix(t*1e-9)
+    
+    # Step edges in display units, drawn as a step plot instead of
+    # sampling every channel over the whole sequence duration
+    edges = np.concatenate(([0], np.cumsum(seq["time"].to_numpy())*1e-9/factor))
     
     data = {}
 
     for i in ["ch1", "ch2", "ch3", "ch4"]:
         if i in seq:
-            data[i] = np.repeat(seq[i], np.round(seq.time*expand))
-        
-        
-        
-    t = np.sum(seq.time)
-    factor, prefix = getPrefix(t*1e-9)
-    ts = np.linspace(0, t*1e-9/factor, round(t*expand)) 
+            # Repeat the last state so the final step is drawn to the end
+            values = seq[i].to_numpy()
+            data[i] = np.append(values, values[-1])
         
     labels = []
     centers = []
     for i, ch in enumerate(data):
         offset = i*1.2 + 0.2
         centers.append(offset + 0.5)
-        plt.plot(ts, data[ch] + offset, label = ch)
-        plt.fill_between(ts, data[ch] + offset, offset, alpha = 0.5)
+        plt.step(edges, data[ch] + offset, where = 'post', label = ch)
+        plt.fill_between(edges, data[ch] + offset, offset, step = 'post', alpha = 0.5)
         labels.append(ch)
     
     plt.gca().set(
@@ -0,0 +1,39 @@
+"""
+Copyright (C) 2026 Bence Göblyös
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see https://www.gnu.org/licenses/.
+"""
+
+import numpy as np
+
+def meanStd(data):
+    """
+    Compute the mean and the (population) standard deviation of a sample array.
+    The mean is computed once and reused for the standard deviation.
+
+    Parameters
+    ----------
+    data : array of floats
+        Samples, e.g. the lock-in readout of a single point.
+
+    Returns
+    -------
+    mean : float
+        Mean of the samples.
+    std : float
+        Standard deviation of the samples.
+    """
+    data = np.asarray(data, dtype = np.float64)
+    mean = data.mean()
+    # Two-pass formula, the sum of squares shortcut loses precision when the noise is small compared to the mean
+    std = data.std(mean = mean)
+    return mean, std
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import math
+import functools
+
 prefixDict = {
     "P": 1e15,
     "T": 1e12,
@@ -14,6 +17,8 @@ prefixDict = {
     "f": 1e-15
 }
 
+# Sequences repeat the same step durations, so labels are memoized
+@functools.lru_cache(maxsize = 256)
 def formatPrefix(n, unit, precision = -1):
             
     factor, prefixStr = getPrefix(n)
@@ -26,7 +31,15 @@ def formatPrefix(n, unit, precision = -1):
 
     return f"{rounded} {prefixStr}{unit}"
 
+# (factor, prefix) pairs in ascending order, one for every third power of ten
+_prefixTable = sorted((factor, prefix) for (prefix, factor) in prefixDict.items())
+_prefixOffset = _prefixTable.index((1, ""))
+
 def getPrefix(n):
-    for prefix in prefixDict:
-        if n >= prefixDict[prefix]:
-            return prefixDict[prefix], prefix
\ No newline at end of file
+    if n == 0:
+        return 1, ""
+
+    # Index directly by the exponent instead of scanning the prefixes
+    i = math.floor(math.log10(abs(n)) / 3) + _prefixOffset
+    i = max(0, min(len(_prefixTable) - 1, i))
+    return _prefixTable[i]
\ No newline at end of file
@@ -20,9 +20,9 @@ this program. If not, see https://www.gnu.org/licenses/.
 from Devices.LockIn import SR830M
 from Devices.PicoPulse import PicoPulse
 from Devices.LO import KuhnePLL
+from Utilities.Resources import getResourceManager
 
 
-import pyvisa                    # Required for communication
 import matplotlib.pyplot as plt  # Plots
 import numpy as np               # Maths
 import pandas as pd              # DataFrames
@@ -45,6 +45,43 @@ pico_pins = {
     'laser': 'ch4'
 }
 
+#%% Open devices
+# Opened devices by address, together with the resource manager they were opened with
+_devices = {}
+
+def getDevice(addr):
+    """
+    Open the device at the given address on first use. Later calls return
+    the same handle, so the cells below can be re-run without opening new sessions.
+    VISA devices are opened again if the shared resource manager was closed in the meantime.
+
+    Parameters
+    ----------
+    addr : str
+        VISA address or serial port of the device, one of the constants above.
+
+    Returns
+    -------
+    Device driver object.
+    """
+    rm = getResourceManager()
+    if addr in _devices:
+        (owner, device) = _devices[addr]
+        if owner is None or owner is rm:
+            return device
+    
+    if addr == pico_addr:
+        _devices[addr] = (rm, PicoPulse(rm, pico_addr, pico_pins))
+    elif addr == lockin_addr:
+        _devices[addr] = (rm, SR830M(rm, lockin_addr))
+    elif addr == osc_addr:
+        # Plain serial port, does not depend on the resource manager
+        _devices[addr] = (None, KuhnePLL(osc_addr))
+    else:
+        raise Exception(f'Unknown device address: {addr}')
+    
+    return _devices[addr][1]
+
 #%% Turn off laser
 idle_seq = pd.DataFrame(
         columns = ['time', 'lockin', 'laser'],
@@ -54,10 +91,8 @@ idle_seq = pd.DataFrame(
         ]
     )
 
-rm = pyvisa.ResourceManager()
-pico = PicoPulse(rm, pico_addr, pico_pins)
+pico = getDevice(pico_addr)
 pico.sendSequence(idle_seq)
-rm.close()
 
 #%% Turn on laser for adjustment
 idle_seq = pd.DataFrame(
@@ -68,19 +103,15 @@ idle_seq = pd.DataFrame(
         ]
     )
 
-rm = pyvisa.ResourceManager()
-pico = PicoPulse(rm, pico_addr, pico_pins)
+pico = getDevice(pico_addr)
 pico.sendSequence(idle_seq)
-rm.close()
 
 #%% Lock-in amplifier demo
 
-rm = pyvisa.ResourceManager()
-lockin = SR830M(rm, lockin_addr)
+lockin = getDevice(lockin_addr)
 
-# Read single values
-x, y, r, theta = lockin.snapshot(['x', 'y', 'r', 'theta'])
-reference, aux1 = lockin.snapshot(['ref', 'aux1'])
+# Read single values, up to six of them in one query
+x, y, r, theta, reference, aux1 = lockin.snapshot(['x', 'y', 'r', 'theta', 'ref', 'aux1'])
 
 # Sample X and Y for 8 seconds with an automatic sample rate
 # (calculated from time constant)
@@ -90,11 +121,7 @@ xs, ys = lockin.multiRead('x', 'y', 8)
 # Setting channel 1 to None speeds up readout
 _, aux4s = lockin.multiRead(None, 'aux4', 10, 4)
 
-rm.close()
-
 #%% MW oscillator demo
-osc = KuhnePLL(osc_addr)
+osc = getDevice(osc_addr)
 osc.setGHz(2.87)
 
-del osc
-